@@ -7,6 +7,30 @@ def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
 
+def speedups():
+    """Optionally compiles the protocol hot paths with Cython.
+
+    Enabled by setting ``TINYRPC_ENABLE_SPEEDUPS=1`` during installation.
+    Cython must already be installed and visible to the build, i.e. pip needs
+    ``--no-build-isolation`` (and ``--no-binary tinyrpc`` to build from source).
+    The compiled module takes precedence over its ``.py`` source on import;
+    without it the pure-python module is used unchanged.
+    """
+    if os.environ.get('TINYRPC_ENABLE_SPEEDUPS') != '1':
+        return []
+
+    from Cython.Build import cythonize
+
+    return cythonize(
+        ['tinyrpc/protocols/msgpackrpc.py'],
+        compiler_directives={
+            'language_level': 3,
+            # type hints are documentation, parse_* also accept bytearray etc.
+            'annotation_typing': False,
+        }
+    )
+
+
 setup(
     name='tinyrpc',
     version='1.0.4',
@@ -15,6 +39,7 @@ setup(
     long_description=read('README.rst'),
     long_description_content_type="text/x-rst",
     packages=find_packages(exclude=['tests', 'examples']),
+    ext_modules=speedups(),
     keywords='json rpc json-rpc jsonrpc 0mq zmq zeromq',
     author='Marc Brinkmann',
     author_email='git@marcbrinkmann.de',
@@ -22,11 +47,12 @@ setup(
     maintainer_email='leo@noordergraaf.net',
     url='http://github.com/mbr/tinyrpc',
     license='MIT',
-    install_requires=['six'],
     extras_require={
         'gevent': ['gevent'],
         'httpclient': ['requests', 'websocket-client', 'gevent-websocket'],
         'msgpack': ['msgpack'],
+        'msgspec': ['msgpack', 'msgspec'],
+        'ormsgpack': ['msgpack', 'ormsgpack'],
         'websocket': ['gevent-websocket'],
         'wsgi': ['werkzeug'],
         'zmq': ['pyzmq'],
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import importlib.util
+import itertools
+import os
+import threading
+import time
+
 import msgpack
 import six
 import pytest
 
-from tinyrpc import InvalidReplyError, MethodNotFoundError
+from tinyrpc import InvalidReplyError, InvalidRequestError, MethodNotFoundError
 from tinyrpc.protocols.msgpackrpc import (
     MSGPACKRPCParseError,
     MSGPACKRPCInvalidRequestError,
@@ -19,11 +25,15 @@ def _msgpack_equal(a, b):
     return msgpack.unpackb(a) == msgpack.unpackb(b)
 
 
-@pytest.fixture
-def prot():
+@pytest.fixture(params=["default", "msgspec", "ormsgpack"])
+def prot(request):
     from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
 
-    return MSGPACKRPCProtocol()
+    if request.param == "default":
+        return MSGPACKRPCProtocol()
+
+    pytest.importorskip(request.param)
+    return getattr(MSGPACKRPCProtocol, "with_" + request.param)()
 
 
 @pytest.mark.parametrize(
@@ -42,7 +52,7 @@ def prot():
             b"\x93\x02\xa6update\x95\x01\x02\x03\x04\x05",
             {"method": "update", "args": [1, 2, 3, 4, 5]},
         ),
-        (b"\x93\x02\xa6foobar\x90", {"method": "foobar", "args": []}),
+        (b"\x93\x02\xa6foobar\x90", {"method": "foobar", "args": ()}),
     ],
 )
 def test_parsing_good_request_samples(prot, data, attrs):
@@ -52,15 +62,37 @@ def test_parsing_good_request_samples(prot, data, attrs):
         assert getattr(req, k) == v
 
 
+@pytest.mark.parametrize("buffer_type", [bytearray, memoryview])
+def test_parsing_bytes_like_objects(prot, buffer_type):
+    # [0, 1, "subtract", [42, 23]]
+    req = prot.parse_request(buffer_type(b"\x94\x00\x01\xa8subtract\x92*\x17"))
+
+    assert req.method == "subtract"
+    assert req.args == [42, 23]
+
+    # [1, 1, None, 19]
+    reply = prot.parse_reply(buffer_type(b"\x94\x01\x01\xc0\x13"))
+
+    assert reply.unique_id == 1
+    assert reply.result == 19
+
+
 @pytest.mark.parametrize(
     "invalid_msgpack",
     [
         b"\x81\xa3\x66\x6f\x6f\xa4\x62\x61\x72",
         b"\x94\x00\x01\x81\xa3aaa\xa3bb",
         b"garbage",
+        b"\x94\x00\x01\xa1m\x91\x81\x01\x02",  # [0, 1, "m", [{1: 2}]]
+        b"\x93\x02\xa1m\x91\x91\x81\xc0\x01",  # [2, "m", [[{None: 1}]]]
     ],
 )
-def test_parsing_invalid_msgpack(prot, invalid_msgpack):
+def test_parsing_invalid_msgpack(prot, invalid_msgpack, request):
+    if request.node.callspec.params["prot"] == "ormsgpack" and (
+        invalid_msgpack == b"garbage"
+    ):
+        pytest.skip("ormsgpack ignores data trailing the message")
+
     with pytest.raises(MSGPACKRPCParseError):
         prot.parse_request(invalid_msgpack)
 
@@ -93,6 +125,20 @@ def test_parsing_invalid_arguments(prot, invalid_args):
         prot.parse_request(invalid_args)
 
 
+@pytest.mark.parametrize(
+    ("data", "id"),
+    [
+        (b"\x94\x00\x03\xa6update\t", 3),  # [0, 3, "update", 9]
+        (b"\x93\x02\xa3aaa\xc0", None),  # [2, "aaa", None]
+    ],
+)
+def test_invalid_arguments_error_carries_request_id(prot, data, id):
+    with pytest.raises(MSGPACKRPCInvalidParamsError) as exc_info:
+        prot.parse_request(data)
+
+    assert exc_info.value.error_respond().unique_id == id
+
+
 @pytest.mark.parametrize(
     ("data", "id", "result"),
     [
@@ -100,6 +146,7 @@ def test_parsing_invalid_arguments(prot, invalid_args):
         (b"\x94\x01\x02\xc0\xed", 2, -19),  # [1, 2, None, -19]
         (b"\x94\x01\x03\xc0\x13", 3, 19),  # [1, 3, None, 19]
         (b"\x94\x01\x04\xc0\x13", 4, 19),  # [1, 4, None, 19]
+        (b"\x94\x01\x05\xc0\xc0", 5, None),  # [1, 5, None, None]
     ],
 )
 def test_good_reply_samples(prot, data, id, result):
@@ -139,6 +186,9 @@ def test_good_error_reply_samples(prot, data, id, code, message):
     ],
 )
 def test_proper_construction_of_error_codes(prot, exc, code, message):
+    assert exc().args == (message,)
+    assert exc("custom").args == ("custom",)
+
     reply = exc().error_respond().serialize()
     assert isinstance(reply, bytes)
 
@@ -148,6 +198,158 @@ def test_proper_construction_of_error_codes(prot, exc, code, message):
     assert err[2] == [code, message]
 
 
+def test_error_subclass_with_computed_message():
+    class PropertyMessageError(MSGPACKRPCInvalidRequestError):
+        @property
+        def message(self):
+            return "computed"
+
+    class InstanceMessageError(MSGPACKRPCInvalidRequestError):
+        def __init__(self):
+            self.message = "from instance"
+            super().__init__()
+
+    assert PropertyMessageError().args == ("computed",)
+    assert str(PropertyMessageError()) == "computed"
+    assert InstanceMessageError().args == ("from instance",)
+    assert msgpack.unpackb(
+        PropertyMessageError().error_respond().serialize(), raw=False
+    ) == [1, None, [-32600, "computed"], None]
+
+
+def test_error_without_request_id_serializes_from_cache(prot):
+    response = MSGPACKRPCParseError().error_respond()
+
+    assert response.serialize() is MSGPACKRPCParseError._cached_null_id_bytes
+    assert response.serialize() == b"\x94\x01\xc0\x92\xd1\x80D\xabParse error\xc0"
+
+
+def test_modified_error_response_bypasses_cache(prot):
+    response = MSGPACKRPCParseError().error_respond()
+    response.unique_id = 7
+
+    assert msgpack.unpackb(response.serialize(), raw=False) == [
+        1,
+        7,
+        [-32700, "Parse error"],
+        None,
+    ]
+
+    response.unique_id = None
+    response.error = "Custom parse error"
+
+    assert msgpack.unpackb(response.serialize(), raw=False) == [
+        1,
+        None,
+        [-32700, "Custom parse error"],
+        None,
+    ]
+
+    response = MSGPACKRPCParseError().error_respond()
+    response._msgpackrpc_error_code = -32000
+
+    assert msgpack.unpackb(response.serialize(), raw=False) == [
+        1,
+        None,
+        [-32000, "Parse error"],
+        None,
+    ]
+
+
+def test_error_class_changes_bypass_cache(monkeypatch):
+    monkeypatch.setattr(MSGPACKRPCParseError, "message", "Changed")
+
+    response = MSGPACKRPCParseError().error_respond()
+
+    assert msgpack.unpackb(response.serialize(), raw=False) == [
+        1,
+        None,
+        [-32700, "Changed"],
+        None,
+    ]
+
+
+def test_error_class_with_unpackable_code_is_not_cached():
+    class UnpackableCodeError(MSGPACKRPCInvalidRequestError):
+        msgpackrpc_error_code = object()
+
+    assert UnpackableCodeError._cached_null_id_bytes is None
+
+    response = UnpackableCodeError().error_respond()
+
+    with pytest.raises(TypeError):
+        response.serialize()
+
+
+def test_error_response_serializes_error_as_string(prot):
+    response = prot.create_request("foo").error_respond("bar")
+    response.error = ValueError("baz")
+
+    assert msgpack.unpackb(response.serialize(), raw=False)[2] == [-32000, "baz"]
+
+
+@pytest.mark.parametrize(
+    ("data", "id", "code", "message"),
+    [
+        (b"\xc0", None, -32600, "Invalid request"),  # None
+        (b"\x94\x00\x03\xa6update\t", 3, -32602, "Invalid params"),
+    ],
+)
+def test_parse_errors_respond_with_protocol_packer(data, id, code, message):
+    from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
+
+    packed = []
+
+    def packer(obj):
+        packed.append(obj)
+        return msgpack.packb(obj)
+
+    prot = MSGPACKRPCProtocol(packer=packer)
+
+    with pytest.raises(InvalidRequestError) as exc_info:
+        prot.parse_request(data)
+
+    response = exc_info.value.error_respond()
+
+    assert msgpack.unpackb(response.serialize()) == [1, id, [code, message], None]
+    assert packed == [(1, id, (code, message), None)]
+
+
+def test_messages_do_not_allocate_instance_dict(prot):
+    request = prot.create_request("foo", [1])
+
+    for message in (request, request.respond(1), request.error_respond("bar")):
+        assert not hasattr(message, "__dict__")
+
+
+class _YieldingDict(dict):
+    def items(self):
+        # lets other threads run in the middle of packing
+        time.sleep(0)
+        return super().items()
+
+
+def test_serialize_from_concurrent_threads(prot):
+    errors = []
+
+    def serialize(n):
+        try:
+            for _ in range(200):
+                request = prot.create_request("foo", [_YieldingDict(a=n), "x" * n])
+                decoded = msgpack.unpackb(request.serialize(), raw=False)
+                assert decoded[2:] == ["foo", [{"a": n}, "x" * n]]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=serialize, args=(n,)) for n in range(1, 6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+
+
 def test_notification_yields_None_response(prot):
     # [2, "update", [1,2,3,4,5]]
     data = b"\x93\x02\xa6update\x95\x01\x02\x03\x04\x05"
@@ -210,7 +412,7 @@ def test_request_generation(prot):
 
 def test_jsonrpc_spec_v2_example1(prot):
     # reset id counter
-    prot._id_counter = 0
+    prot._next_id = itertools.count(1).__next__
 
     request = prot.create_request("subtract", [42, 23])
 
@@ -385,8 +587,29 @@ def test_can_get_custom_error_messages_out(prot):
     assert decoded[2][1] == custom_msg
 
 
+@pytest.mark.parametrize(
+    ("error", "code", "message"),
+    [
+        (InvalidRequestError("ignored"), -32600, "Invalid request"),
+        (MethodNotFoundError("ignored"), -32601, "Method not found"),
+        (MSGPACKRPCInvalidParamsError(), -32602, "Invalid params"),
+        (KeyError("foo"), -32000, "'foo'"),
+        ("plain message", -32000, "plain message"),
+    ],
+)
+def test_error_respond_maps_errors_to_codes(prot, error, code, message):
+    request = prot.create_request("foo")
+
+    decoded = msgpack.unpackb(request.error_respond(error).serialize(), raw=False)
+
+    assert decoded[2] == [code, message]
+
+
 def test_accepts_empty_but_not_none_args(prot):
-    prot.create_request("foo", args=[])
+    request = prot.create_request("foo", args=[])
+
+    assert request.args == ()
+    assert request.serialize() == b"\x94\x00\x01\xa3foo\x90"
 
 
 def test_rejects_nonempty_kwargs(prot):
@@ -406,8 +629,120 @@ def test_accepts_empty_kwargs(prot):
         b"\x94\x00\x01\xc0\xa5hello",  # not a reply (message type is request)
         b"\x94\x01\xc0\xc0\xa5hello",  # missing message ID in response
         b"\x94\x01\x01\xa5hello\xa5hello",  # contains error _and_ result
+        b"\x84\x01\x00\x07\x00\xc0\x00*\x00",  # {1: 0, 7: 0, None: 0, 42: 0}
+        b"\x94\x01\x01\xc0\x81\x01\x02",  # [1, 1, None, {1: 2}]
     ],
 )
 def test_invalid_replies(prot, data):
     with pytest.raises(InvalidReplyError):
         prot.parse_reply(data)
+
+
+@pytest.fixture
+def schema_module():
+    """A copy of the module loaded after msgspec was imported.
+
+    The copy decodes with the msgspec schemas, while the module imported above
+    stays untouched for the other tests.
+    """
+    pytest.importorskip("msgspec")
+    import tinyrpc.protocols
+
+    spec = importlib.util.spec_from_file_location(
+        "tinyrpc.protocols._msgpackrpc_msgspec",
+        os.path.join(os.path.dirname(tinyrpc.protocols.__file__), "msgpackrpc.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    assert module._unpack_request is not None
+    return module
+
+
+@pytest.fixture
+def schema_prot(schema_module):
+    return schema_module.MSGPACKRPCProtocol()
+
+
+def test_schema_parses_request(schema_prot):
+    # [0, 1, "subtract", [42, 23]]
+    req = schema_prot.parse_request(b"\x94\x00\x01\xa8subtract\x92*\x17")
+
+    assert not req.one_way
+    assert req.unique_id == 1
+    assert req.method == "subtract"
+    assert req.args == [42, 23]
+
+
+def test_schema_parses_notification(schema_prot):
+    # [2, "update", [1, 2, 3, 4, 5]]
+    req = schema_prot.parse_request(b"\x93\x02\xa6update\x95\x01\x02\x03\x04\x05")
+
+    assert req.one_way
+    assert req.unique_id is None
+    assert req.method == "update"
+    assert req.args == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize(
+    ("data", "id"),
+    [
+        (b"\x94\x00\x03\xa6update\t", 3),  # [0, 3, "update", 9]
+        (b"\x94\x00\x03\xa6foobar\xc0", 3),  # [0, 3, "foobar", None]
+        (b"\x93\x02\xa3aaa\xc0", None),  # [2, "aaa", None]
+    ],
+)
+def test_schema_invalid_arguments(schema_module, schema_prot, data, id):
+    with pytest.raises(schema_module.MSGPACKRPCInvalidParamsError) as exc_info:
+        schema_prot.parse_request(data)
+
+    assert exc_info.value.error_respond().unique_id == id
+
+
+@pytest.mark.parametrize(
+    ("data", "error"),
+    [
+        (b"garbage", "MSGPACKRPCParseError"),
+        (b"\x94\x00\x01\xa1m\x91\x81\x01\x02", "MSGPACKRPCParseError"),
+        (b"\x93\x02\xa1m\x91\x91\x81\xc0\x01", "MSGPACKRPCParseError"),
+        (b"\x94\x00\xc0\xa3aaa\x90", "MSGPACKRPCInvalidRequestError"),
+        (b"\x95\x00\x02\xa3aaa\x90\xc0", "MSGPACKRPCInvalidRequestError"),
+        (b"\x94\x02\xa3aaa\x90\xc0", "MSGPACKRPCInvalidRequestError"),
+        (b"\x93\x02\x01\x90", "MSGPACKRPCInvalidRequestError"),
+    ],
+)
+def test_schema_invalid_requests(schema_module, schema_prot, data, error):
+    with pytest.raises(getattr(schema_module, error)):
+        schema_prot.parse_request(data)
+
+
+def test_schema_parses_replies(schema_prot):
+    # [1, 1, None, 19]
+    reply = schema_prot.parse_reply(b"\x94\x01\x01\xc0\x13")
+
+    assert reply.unique_id == 1
+    assert reply.result == 19
+
+    # [1, 5, [1234, "Error"], None]
+    reply = schema_prot.parse_reply(b"\x94\x01\x05\x92\xcd\x04\xd2\xa5Error\xc0")
+
+    assert reply.unique_id == 5
+    assert reply._msgpackrpc_error_code == 1234
+    assert reply.error == "Error"
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"\x97\x01",  # complete garbage
+        b"\x93\x01\xc0\xa5hello",  # too short
+        b"\x94\x00\x01\xc0\xa5hello",  # not a reply (message type is request)
+        b"\x94\x01\xc0\xc0\xa5hello",  # missing message ID in response
+        b"\x94\x01\x01\xa5hello\xa5hello",  # contains error _and_ result
+        b"\x84\x01\x00\x07\x00\xc0\x00*\x00",  # {1: 0, 7: 0, None: 0, 42: 0}
+        b"\x94\x01\x01\xc0\x81\x01\x02",  # [1, 1, None, {1: 2}]
+    ],
+)
+def test_schema_invalid_replies(schema_prot, data):
+    with pytest.raises(InvalidReplyError):
+        schema_prot.parse_reply(data)
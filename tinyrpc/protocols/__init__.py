@@ -12,6 +12,8 @@ from tinyrpc import exc
 
 class RPCRequest(object):
     """Defines a generic RPC request."""
+    __slots__ = ('unique_id', 'method', 'args', 'kwargs')
+
     def __init__(self) -> None:
         self.unique_id = None
         """Correlation ID used to match request and response.
@@ -166,6 +168,8 @@ class RPCResponse(ABC):
 
         :type: :py:class:`~tinyrpc.exc.RPCError`
     """
+    __slots__ = ('unique_id', )
+
     def __init__(self) -> None:
         self.unique_id = None
         """Correlation ID used to match request and response.
@@ -197,7 +201,11 @@ class RPCErrorResponse(RPCResponse, ABC):
 
         :type: dict
     """
-    error = None
+    __slots__ = ('error', )
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.error = None
 
 
 class RPCBatchResponse(list):
@@ -1,5 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""MSGPACK-RPC Protocol implementation.
+
+This module can use the msgspec_ package to encode and decode messages.
+In order to use msgspec import it before importing tinyrpc.
+Tinyrpc will detect the presence of msgspec and use it automatically.
+
+.. _msgspec: https://pypi.org/project/msgspec
+
+"""
 
 from .. import (
     RPCError,
@@ -12,26 +21,168 @@ from .. import (
     InvalidReplyError,
 )
 
+import functools
+import itertools
+import sys
+import threading
+import warnings
+
 import msgpack
-import six
 
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+if not msgpack.Packer.__module__.endswith("_cmsgpack"):
+    warnings.warn(
+        "msgpack C extension is not available, MSGPACKRPCProtocol falls back "
+        "to the much slower pure-python implementation",
+        RuntimeWarning,
+    )
+
+# A packer is reused for every message so it and its buffer are only set up
+# once. Packers are not thread safe, even the C packer runs python code (e.g.
+# items() of dict subclasses) in the middle of a message, so each thread gets
+# its own.
+_local = threading.local()
+
+
+def _pack(obj):
+    try:
+        packer = _local.packer
+    except AttributeError:
+        packer = _local.packer = msgpack.Packer(use_bin_type=True, autoreset=True)
+    return packer.pack(obj)
+
+
+# Shared by all requests without positional arguments.
+_EMPTY_ARGS = ()
+
+
+def _check_map_keys(items):
+    """Rejects maps with keys other than str or bytes in ``items``.
+
+    msgpack does so by default to guard against hash collision attacks,
+    msgspec needs this check to do the same.
+    """
+    for item in items:
+        item_type = type(item)
+        if item_type is dict:
+            for key in item:
+                if type(key) is not str and type(key) is not bytes:
+                    raise ValueError(
+                        "%s is not allowed for map key" % type(key).__name__
+                    )
+            _check_map_keys(item.values())
+        elif item_type is list or item_type is tuple:
+            _check_map_keys(item)
+
+
+def _strict_map_keys(decode):
+    def unpack(data):
+        obj = decode(data)
+        _check_map_keys((obj,))
+        return obj
+
+    return unpack
+
+
+if "msgspec" in sys.modules:
+    # msgspec was imported before this file, assume the intent is that
+    # it is used in place of msgpack to encode and decode messages.
+    import msgspec
+
+    # The message type is the tag, which array_like structs store as the
+    # first element of the array.
+    class _Request(msgspec.Struct, array_like=True, tag=0, forbid_unknown_fields=True):
+        id: int
+        method: str
+        args: list
+
+    class _Notification(
+        msgspec.Struct, array_like=True, tag=2, forbid_unknown_fields=True
+    ):
+        method: str
+        args: list
+
+    _encode = msgspec.msgpack.Encoder().encode
+    _unpackb = _strict_map_keys(msgspec.msgpack.Decoder().decode)
+    # Valid requests are decoded and validated in one pass, anything else
+    # is left to the generic checks in parse_request to report the error.
+    _unpack_request = msgspec.msgpack.Decoder(Union[_Request, _Notification]).decode
+    _RequestValidationError = msgspec.ValidationError
+    # Validates the reply layout (length, message type and ID) while decoding.
+    _unpack_reply = _strict_map_keys(
+        msgspec.msgpack.Decoder(Tuple[int, int, Any, Any]).decode
+    )
+
+else:
+    # Arrays stay lists, decoding them as tuples would change the type of
+    # nested user data.
+    _unpackb = functools.partial(msgpack.unpackb, raw=False, use_list=True)
+    _unpack_reply = _unpackb
+    _unpack_request = None
+    _encode = _pack
 
 
 class FixedErrorMessageMixin(object):
+    _message_args = None
+    _cached_null_id_bytes = None
+    _cached_null_id_error = None
+    # Set by the protocol that raised the error to encode the error response
+    # with its packer.
+    _pack = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        code = getattr(cls, "msgpackrpc_error_code", None)
+        message = getattr(cls, "message", None)
+        if not isinstance(message, str):
+            # computed, e.g. by a property, only known when raised
+            message = None
+        # Default exception arguments, built once instead of on every raise.
+        cls._message_args = None if message is None else (message,)
+        # Error responses without a request ID are fully determined by the
+        # error class, so they only need to be encoded once.
+        cls._cached_null_id_bytes = None
+        cls._cached_null_id_error = None
+        if code is not None and message is not None:
+            try:
+                cls._cached_null_id_bytes = _encode(
+                    (1, None, (code, str(message)), None)
+                )
+            except Exception:
+                # not cached, the error surfaces when a response is serialized
+                pass
+            else:
+                cls._cached_null_id_error = (code, message)
+
     def __init__(self, *args, **kwargs):
         if not args:
-            args = [self.message]
+            message = self.message
+            args = self._message_args
+            # the message may have been set on the instance or changed since
+            if args is None or args[0] is not message:
+                args = (message,)
 
         self.request_id = kwargs.pop("request_id", None)
         super(FixedErrorMessageMixin, self).__init__(*args, **kwargs)
 
     def error_respond(self):
         response = MSGPACKRPCErrorResponse()
+        if self._pack is not None:
+            response._pack = self._pack
 
         response.error = self.message
         response.unique_id = self.request_id
         response._msgpackrpc_error_code = self.msgpackrpc_error_code
+        if (
+            self.request_id is None
+            and response._pack is _encode
+            and self._cached_null_id_bytes is not None
+        ):
+            code, message = self._cached_null_id_error
+            response._cached_bytes = self._cached_null_id_bytes
+            response._origin_code = code
+            response._origin_message = message
         return response
 
 
@@ -86,50 +237,89 @@ class MSGPACKRPCError(FixedErrorMessageMixin, RPCError):
             self._msgpackrpc_error_code, self.message = error
 
 
+# Messages are packed from tuples, encoded like lists but cheaper to build.
 class MSGPACKRPCSuccessResponse(RPCResponse):
-    def _to_list(self):
-        return [1, self.unique_id, None, self.result]
+    __slots__ = ("result", "_pack")
+
+    def __init__(self):
+        self.unique_id = None
+        self.result = None
+        self._pack = _encode
 
     def serialize(self):
-        return msgpack.packb(self._to_list(), use_bin_type=True)
+        return self._pack((1, self.unique_id, None, self.result))
 
 
 class MSGPACKRPCErrorResponse(RPCErrorResponse):
-    def _to_list(self):
-        return [1, self.unique_id, [self._msgpackrpc_error_code, str(self.error)], None]
+    __slots__ = (
+        "_msgpackrpc_error_code",
+        "_cached_bytes",
+        "_origin_code",
+        "_origin_message",
+        "_pack",
+    )
+
+    def __init__(self):
+        self.unique_id = None
+        self.error = None
+        self._msgpackrpc_error_code = None
+        self._cached_bytes = None
+        self._origin_code = None
+        self._origin_message = None
+        self._pack = _encode
 
     def serialize(self):
-        return msgpack.packb(self._to_list(), use_bin_type=True)
+        if (
+            self._cached_bytes is not None
+            and self.unique_id is None
+            and self._msgpackrpc_error_code == self._origin_code
+            and self.error == self._origin_message
+        ):
+            return self._cached_bytes
+        return self._pack(
+            (1, self.unique_id, (self._msgpackrpc_error_code, str(self.error)), None)
+        )
+
+
+# Generic errors that map onto a fixed MSGPACK-RPC error, looked up along the
+# MRO of the exception type.
+_ERROR_CODES_AND_MESSAGES = {
+    InvalidRequestError: (
+        MSGPACKRPCInvalidRequestError.msgpackrpc_error_code,
+        MSGPACKRPCInvalidRequestError.message,
+    ),
+    MethodNotFoundError: (
+        MSGPACKRPCMethodNotFoundError.msgpackrpc_error_code,
+        MSGPACKRPCMethodNotFoundError.message,
+    ),
+}
 
 
 def _get_code_and_message(error):
-    assert isinstance(error, (Exception, six.string_types))
-    if isinstance(error, Exception):
-        if hasattr(error, "msgpackrpc_error_code"):
-            code = error.msgpackrpc_error_code
-            msg = str(error)
-        elif isinstance(error, InvalidRequestError):
-            code = MSGPACKRPCInvalidRequestError.msgpackrpc_error_code
-            msg = MSGPACKRPCInvalidRequestError.message
-        elif isinstance(error, MethodNotFoundError):
-            code = MSGPACKRPCMethodNotFoundError.msgpackrpc_error_code
-            msg = MSGPACKRPCMethodNotFoundError.message
-        else:
-            # allow exception message to propagate
-            code = MSGPACKRPCServerError.msgpackrpc_error_code
-            msg = str(error)
-    else:
-        code = -32000
-        msg = error
+    assert isinstance(error, (Exception, str))
+    if not isinstance(error, Exception):
+        return MSGPACKRPCServerError.msgpackrpc_error_code, error
+
+    code = getattr(error, "msgpackrpc_error_code", None)
+    if code is not None:
+        return code, str(error)
 
-    return code, msg
+    for cls in type(error).__mro__:
+        code_and_message = _ERROR_CODES_AND_MESSAGES.get(cls)
+        if code_and_message is not None:
+            return code_and_message
+
+    # allow exception message to propagate
+    return MSGPACKRPCServerError.msgpackrpc_error_code, str(error)
 
 
 class MSGPACKRPCRequest(RPCRequest):
     """Defines a MSGPACK-RPC request."""
 
+    __slots__ = ("one_way", "_pack")
+
     def __init__(self):
-        super().__init__()
+        self._pack = _encode
         self.one_way = False
         """Request or Notification.
 
@@ -163,13 +353,20 @@ class MSGPACKRPCRequest(RPCRequest):
         These are the names used in the :py:attr:`method` attribute.
         """
 
-        self.args = []
+        self.args = _EMPTY_ARGS
         """The positional arguments of the method call.
 
-        :type: list
+        :type: list or tuple
 
-        The contents of this list are the positional parameters for the :py:attr:`method` called.
+        The contents of this sequence are the positional parameters for the :py:attr:`method` called.
         It is eventually called as ``method(*args)``.
+        Requests without arguments share an empty tuple.
+        """
+
+        self.kwargs = {}
+        """Always empty, MSGPACK-RPC does not support keyword arguments.
+
+        :type: dict
         """
 
     def error_respond(
@@ -189,6 +386,7 @@ class MSGPACKRPCRequest(RPCRequest):
             return None
 
         response = MSGPACKRPCErrorResponse()
+        response._pack = self._pack
         response.unique_id = None if self.one_way else self.unique_id
 
         code, msg = _get_code_and_message(error)
@@ -212,37 +410,107 @@ class MSGPACKRPCRequest(RPCRequest):
             return None
 
         response = MSGPACKRPCSuccessResponse()
+        response._pack = self._pack
 
         response.result = result
         response.unique_id = self.unique_id
 
         return response
 
-    def _to_list(self):
+    def serialize(self) -> bytes:
+        args = self.args if self.args is not None else _EMPTY_ARGS
         if self.one_way or self.unique_id is None:
-            return [2, self.method, self.args if self.args is not None else []]
+            return self._pack((2, self.method, args))
         else:
-            return [
-                0,
-                self.unique_id,
-                self.method,
-                self.args if self.args is not None else [],
-            ]
-
-    def serialize(self) -> bytes:
-        return msgpack.packb(self._to_list(), use_bin_type=True)
+            return self._pack((0, self.unique_id, self.method, args))
 
 
 class MSGPACKRPCProtocol(RPCProtocol):
-    """MSGPACKRPC protocol implementation."""
+    """MSGPACKRPC protocol implementation.
+
+    By default messages are encoded and decoded with msgpack_, or with msgspec_
+    when it was imported before tinyrpc. Other MSGPACK implementations can be
+    plugged in through the ``packer`` and ``unpacker`` arguments, see also
+    :py:meth:`with_msgspec` and :py:meth:`with_ormsgpack`.
+
+    :param packer: Encodes a message, consisting of lists, tuples and the
+        arguments and results of the RPC calls, into MSGPACK ``bytes``.
+    :type packer: Callable[[Any], bytes]
+    :param unpacker: Decodes a bytes-like object into the message, arrays must
+        be decoded as lists.
+    :type unpacker: Callable[[bytes], Any]
+
+    .. _msgpack: https://pypi.org/project/msgpack
+    .. _msgspec: https://pypi.org/project/msgspec
+    """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        packer: Optional[Callable[[Any], bytes]] = None,
+        unpacker: Optional[Callable[[bytes], Any]] = None,
+        **kwargs
+    ):
         super(MSGPACKRPCProtocol, self).__init__(*args, **kwargs)
-        self._id_counter = 0
+        # count.__next__ is a single C call, which also makes it thread safe.
+        self._next_id = itertools.count(1).__next__
+        self._pack = _encode if packer is None else packer
+        if unpacker is None:
+            self._unpack = _unpackb
+            self._unpack_reply = _unpack_reply
+            self._unpack_request = _unpack_request
+        else:
+            # the schema based decoders only apply to the default unpacker
+            self._unpack = self._unpack_reply = unpacker
+            self._unpack_request = None
+
+    @classmethod
+    def with_msgspec(cls, *args, **kwargs) -> "MSGPACKRPCProtocol":
+        """Creates a protocol instance that uses msgspec_ for MSGPACK.
+
+        Unlike importing msgspec before tinyrpc, requests and replies are
+        decoded generically and validated by the protocol.
+
+        All arguments are passed on to the constructor.
+
+        :rtype: :py:class:`MSGPACKRPCProtocol`
+        """
+        import msgspec
+
+        return cls(
+            *args,
+            packer=msgspec.msgpack.Encoder().encode,
+            unpacker=_strict_map_keys(msgspec.msgpack.Decoder().decode),
+            **kwargs
+        )
+
+    @classmethod
+    def with_ormsgpack(cls, *args, **kwargs) -> "MSGPACKRPCProtocol":
+        """Creates a protocol instance that uses ormsgpack_ for MSGPACK.
+
+        Note that ormsgpack ignores any data trailing the first MSGPACK object,
+        where the other implementations treat it as a parse error. It also
+        rejects maps with bytes keys, which the others accept.
+
+        All arguments are passed on to the constructor.
+
+        :rtype: :py:class:`MSGPACKRPCProtocol`
+
+        .. _ormsgpack: https://pypi.org/project/ormsgpack
+        """
+        import ormsgpack
+
+        return cls(
+            *args,
+            packer=functools.partial(
+                ormsgpack.packb, option=ormsgpack.OPT_NON_STR_KEYS
+            ),
+            unpacker=ormsgpack.unpackb,
+            **kwargs
+        )
 
     def _get_unique_id(self):
-        self._id_counter += 1
-        return self._id_counter
+        return self._next_id()
 
     def request_factory(self) -> "MSGPACKRPCRequest":
         """Factory for request objects.
@@ -268,6 +536,7 @@ class MSGPACKRPCProtocol(RPCProtocol):
 
         :param str method: The method name to invoke.
         :param list args: The positional arguments to call the method with.
+            These are stored as a tuple.
         :param dict kwargs: The keyword arguments to call the method with; must
             be ``None`` as the protocol does not support keyword arguments.
         :param bool one_way: The request is an update, i.e. it does not expect a reply.
@@ -279,147 +548,160 @@ class MSGPACKRPCProtocol(RPCProtocol):
             raise MSGPACKRPCInvalidRequestError("Does not support kwargs")
 
         request = self.request_factory()
+        request._pack = self._pack
         request.one_way = one_way
 
         if not one_way:
             request.unique_id = self._get_unique_id()
 
         request.method = method
-        request.args = list(args) if args is not None else []
+        request.args = tuple(args) if args else _EMPTY_ARGS
         request.kwargs = None
 
         return request
 
     def parse_reply(
-        self, data: bytes
+        self, data: Union[bytes, bytearray, memoryview]
     ) -> Union["MSGPACKRPCSuccessResponse", "MSGPACKRPCErrorResponse"]:
         """De-serializes and validates a response.
 
         Called by the client to reconstruct the serialized :py:class:`MSGPACKRPCResponse`.
 
-        :param bytes data: The data stream received by the transport layer containing the
-            serialized response.
+        :param data: The data stream received by the transport layer containing the
+            serialized response. Any bytes-like object is decoded in place, there is no
+            need to copy it into a :py:class:`bytes` object first.
+        :type data: bytes, bytearray or memoryview
         :return: A reconstructed response.
         :rtype: :py:class:`MSGPACKRPCSuccessResponse` or :py:class:`MSGPACKRPCErrorResponse`
         :raises InvalidReplyError: if the response is not valid MSGPACK or does not conform
             to the standard.
         """
         try:
-            rep = msgpack.unpackb(data, raw=False)
+            rep = self._unpack_reply(data)
         except Exception as e:
             raise InvalidReplyError(e)
 
-        if len(rep) != 4:
+        if not isinstance(rep, (list, tuple)) or len(rep) != 4:
             raise InvalidReplyError("MSGPACKRPC spec requires reply of length 4")
 
-        if rep[0] != 1:
-            raise InvalidReplyError("Invalid MSGPACK message type")
+        message_type, unique_id, error, result = rep
 
-        if not isinstance(rep[1], int):
-            raise InvalidReplyError("Invalid or missing message ID in response")
+        if message_type != 1 or not isinstance(unique_id, int):
+            raise InvalidReplyError("Invalid MSGPACK message type or message ID")
 
-        if rep[2] is not None and rep[3] is not None:
+        if error is None:
+            response = MSGPACKRPCSuccessResponse()
+            response._pack = self._pack
+            response.result = result
+        elif result is not None:
             raise InvalidReplyError("Reply must contain only one of result and error.")
-
-        if rep[2] is not None:
+        else:
             response = MSGPACKRPCErrorResponse()
-            if isinstance(rep[2], list) and len(rep[2]) == 2:
-                code, message = rep[2]
-                if isinstance(code, int) and isinstance(message, str):
-                    response.error = str(message)
-                    response._msgpackrpc_error_code = int(code)
-                else:
-                    response.error = rep[2]
-                    response._msgpackrpc_error_code = None
+            response._pack = self._pack
+            if (
+                isinstance(error, list)
+                and len(error) == 2
+                and isinstance(error[0], int)
+                and isinstance(error[1], str)
+            ):
+                response._msgpackrpc_error_code, response.error = error
             else:
-                response.error = rep[2]
+                response.error = error
                 response._msgpackrpc_error_code = None
-        else:
-            response = MSGPACKRPCSuccessResponse()
-            response.result = rep[3]
 
-        response.unique_id = rep[1]
+        response.unique_id = unique_id
 
         return response
 
-    def parse_request(self, data: bytes) -> "MSGPACKRPCRequest":
+    def parse_request(
+        self, data: Union[bytes, bytearray, memoryview]
+    ) -> "MSGPACKRPCRequest":
         """De-serializes and validates a request.
 
         Called by the server to reconstruct the serialized :py:class:`MSGPACKRPCRequest`.
 
-        :param bytes data: The data stream received by the transport layer containing the
-            serialized request.
+        :param data: The data stream received by the transport layer containing the
+            serialized request. Any bytes-like object is decoded in place, there is no
+            need to copy it into a :py:class:`bytes` object first.
+        :type data: bytes, bytearray or memoryview
         :return: A reconstructed request.
         :rtype: :py:class:`MSGPACKRPCRequest`
         :raises MSGPACKRPCParseError: if the ``data`` cannot be parsed as valid MSGPACK.
         :raises MSGPACKRPCInvalidRequestError: if the request does not comply with the standard.
         """
         try:
-            req = msgpack.unpackb(data, raw=False)
-        except Exception:
-            raise MSGPACKRPCParseError()
-
-        if not isinstance(req, list):
-            raise MSGPACKRPCInvalidRequestError()
-
-        if len(req) < 2:
-            raise MSGPACKRPCInvalidRequestError()
-
-        if req[0] == 0:
-            # MSGPACK request
-            request_id = req[1]
-            if not isinstance(request_id, int):
+            if self._unpack_request is not None:
+                try:
+                    req = self._unpack_request(data)
+                    _check_map_keys(req.args)
+                except _RequestValidationError:
+                    # fall through, the checks below determine the exact error
+                    pass
+                except Exception:
+                    raise MSGPACKRPCParseError()
+                else:
+                    request = MSGPACKRPCRequest()
+                    request._pack = self._pack
+                    if type(req) is _Request:
+                        request.unique_id = req.id
+                    else:
+                        request.one_way = True
+                    request.method = req.method
+                    request.args = req.args or _EMPTY_ARGS
+                    return request
+
+            try:
+                req = self._unpack(data)
+            except Exception:
+                raise MSGPACKRPCParseError()
+
+            if not isinstance(req, list) or len(req) < 2:
                 raise MSGPACKRPCInvalidRequestError()
 
-            if len(req) == 4:
-                return self._parse_request(req)
-            else:
-                raise MSGPACKRPCInvalidRequestError(request_id=request_id)
-        elif req[0] == 2:
-            # MSGPACK notification
-            if len(req) == 3:
-                return self._parse_notification(req)
+            if req[0] == 0:
+                # MSGPACK request
+                request_id = req[1]
+                if not isinstance(request_id, int):
+                    raise MSGPACKRPCInvalidRequestError()
+
+                if len(req) != 4:
+                    raise MSGPACKRPCInvalidRequestError(request_id=request_id)
+
+                one_way = False
+                method = req[2]
+                params = req[3]
+            elif req[0] == 2:
+                # MSGPACK notification
+                if len(req) != 3:
+                    raise MSGPACKRPCInvalidRequestError()
+
+                one_way = True
+                request_id = None
+                method = req[1]
+                params = req[2]
             else:
                 raise MSGPACKRPCInvalidRequestError()
-        else:
-            raise MSGPACKRPCInvalidRequestError()
-
-    def _parse_notification(self, req):
-        if not isinstance(req[1], six.string_types):
-            raise MSGPACKRPCInvalidRequestError()
-
-        request = MSGPACKRPCRequest()
-        request.one_way = True
-        request.method = req[1]
 
-        params = req[2]
-        # params should not be None according to the spec; if there are
-        # no params, an empty array must be used
-        if isinstance(params, list):
-            request.args = params
-        else:
-            raise MSGPACKRPCInvalidParamsError(request_id=req[1])
-
-        return request
-
-    def _parse_request(self, req):
-        if not isinstance(req[2], six.string_types):
-            raise MSGPACKRPCInvalidRequestError(request_id=req[1])
-
-        request = MSGPACKRPCRequest()
-        request.one_way = False
-        request.method = req[2]
-        request.unique_id = req[1]
-
-        params = req[3]
-        # params should not be None according to the spec; if there are
-        # no params, an empty array must be used
-        if isinstance(params, list):
-            request.args = params
-        else:
-            raise MSGPACKRPCInvalidParamsError(request_id=req[1])
+            if not isinstance(method, str):
+                raise MSGPACKRPCInvalidRequestError(request_id=request_id)
 
-        return request
+            # params should not be None according to the spec; if there are
+            # no params, an empty array must be used
+            if not isinstance(params, list):
+                raise MSGPACKRPCInvalidParamsError(request_id=request_id)
+
+            request = MSGPACKRPCRequest()
+            request._pack = self._pack
+            request.one_way = one_way
+            request.unique_id = request_id
+            request.method = method
+            request.args = params or _EMPTY_ARGS
+
+            return request
+        except RPCError as e:
+            # the error response is encoded like the other messages
+            e._pack = self._pack
+            raise
 
     def raise_error(
         self, error: Union["MSGPACKRPCErrorResponse", Dict[str, Any]]